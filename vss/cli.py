@@ -18,7 +18,9 @@ from vss.msft_loader import (load_metadata,
                              create_index, 
                              mark_loader_started,
                              mark_loader_completed,
-                             mark_loader_failed)
+                             mark_loader_failed,
+                             stream_load,
+                             memory_report)
 
 from vss.wsapi import run as run_wsapi
 
@@ -60,9 +62,21 @@ class LoadCommand(Command):
         {--pipeline-interval=50000 : Amount to break data load into for pipeline}
         {--reduction-factor=3 : Amount to divide pipeline by for embedding load}
         {--retry-count=20 : Number of times to retry redis for index creation}
+        {--compact : Only store indexed fields per paragraph, with the rest of the returned fields shared per filing}
+        {--stream : Use the streaming loader (bounded memory) instead of Prefect/Dask}
+        {--batch-size=5000 : Rows per batch/pipeline for the streaming loader}
+        {--processes=2 : Number of files loaded in parallel (one process each) for the streaming loader}
+        {--writers=4 : Number of Redis writer threads per process for the streaming loader}
+        {--queue-size=8 : Max batches buffered between reader and writers per process for the streaming loader}
     '''
     def handle(self):
 
+        if self.option('stream'):
+            for option in ('batch-size', 'processes', 'writers', 'queue-size'):
+                if int(self.option(option)) < 1:
+                    self.line(f'<error>--{option} must be at least 1</error>')
+                    return 1
+
         metadata_files = glob('data/metadata*')
     
         if not metadata_files:
@@ -78,12 +92,13 @@ class LoadCommand(Command):
 
         redis_url = environ.get('VSS_REDIS_URL', self.option('redis-url'))
         retry_count = int(self.option('retry-count'))
+        compact = self.option('compact')
         with self.spin(f'<info>Connecting to Redis @ <comment>{redis_url}</info>', f'<info>Connected to Redis @ <comment>{redis_url}</info>'):
             success = False
             tries = 0
             while not success:
                 try:
-                    create_index(redis_url)
+                    create_index(redis_url, compact)
                     success = True
                 except ConnectionError as e:
                     self.line(f'<error>Error creating index: {e}</error>', verbosity=DEBUG)
@@ -101,8 +116,11 @@ class LoadCommand(Command):
         self.info('Index Created!')
         self.line(f'<info>Found</info> <comment>{len(metadata_files)}</comment> <info>metadata files</info>')
         mark_loader_started(redis_url)
+        if self.option('stream'):
+            return self.stream(metadata_files, redis_url, compact)
+
         with Flow('loader', executor=DaskExecutor()) as flow:
-            file_keys_and_offsets = load_metadata.map(*(metadata_files, unmapped(redis_url), unmapped(pipeline_interval)))
+            file_keys_and_offsets = load_metadata.map(*(metadata_files, unmapped(redis_url), unmapped(pipeline_interval), unmapped(compact)))
             load_embeddings.map(*(file_keys_and_offsets, unmapped(redis_url), unmapped(pipeline_interval/reduction_factor)))
 
         self.line('<error>Handing off to Prefect/Dask</error>')
@@ -117,6 +135,56 @@ class LoadCommand(Command):
 
         self.line(f'<info>Flow Completed! Total Execution Time:</info> <comment>{end-start:0.2f} seconds</comment>')
 
+    def stream(self, metadata_files, redis_url, compact):
+        batch_size = int(self.option('batch-size'))
+        processes = int(self.option('processes'))
+        writers = int(self.option('writers'))
+        queue_size = int(self.option('queue-size'))
+
+        self.line('<error>Streaming with process/writer pool</error>')
+        start = perf_counter()
+        try:
+            total = stream_load(metadata_files, redis_url, batch_size, processes, writers, queue_size, compact)
+        except Exception:
+            mark_loader_failed(redis_url)
+            raise
+        end = perf_counter()
+
+        mark_loader_completed(redis_url)
+        self.line(f'<info>Stream Completed! Loaded</info> <comment>{total}</comment> <info>records. Total Execution Time:</info> <comment>{end-start:0.2f} seconds</comment>')
+
+class MemoryReportCommand(Command):
+    '''
+    Compare memory per record between the full and compact document layouts
+
+    memory_report
+        {--r|redis-url=redis://localhost:6379 : Redis to measure against - can also set with VSS_REDIS_URL env var}
+        {--f|metadata-file= : Metadata file to sample rows from (defaults to the first found)}
+        {--s|sample=1000 : Number of rows to sample}
+    '''
+    def handle(self):
+        metadata_file = self.option('metadata-file')
+        if not metadata_file:
+            metadata_files = sorted(glob('data/metadata*'))
+            if not metadata_files:
+                self.line('<error>No metadata files found - run load to download them</error>')
+                return 1
+            metadata_file = metadata_files[0]
+
+        redis_url = environ.get('VSS_REDIS_URL', self.option('redis-url'))
+        sample = int(self.option('sample'))
+        if sample < 1:
+            self.line('<error>--sample must be at least 1</error>')
+            return 1
+
+        with self.spin(f'<info>Sampling <comment>{sample}</comment> rows from <comment>{metadata_file}</comment></info>', '<info>Sampled!</info>'):
+            report = memory_report(metadata_file, redis_url, sample)
+
+        self.line(f'<info>Records:</info> <comment>{report["records"]}</comment> <info>across</info> <comment>{report["documents"]}</comment> <info>filings</info>')
+        self.line(f'<info>Full layout:</info> <comment>{report["full"]:0.0f} bytes</comment> <info>per record</info>')
+        self.line(f'<info>Compact layout:</info> <comment>{report["compact"]:0.0f} bytes</comment> <info>per record</info> ({report["paragraph"]:0.0f} paragraph + {report["document"]:0.0f} shared document)')
+        self.line(f'<info>Saved:</info> <comment>{report["full"]-report["compact"]:0.0f} bytes ({1-report["compact"]/report["full"]:0.1%})</comment> <info>per record</info>')
+
 class RunCommand(Command):
     '''
     Run the VSS microservice.
@@ -141,4 +209,5 @@ def run():
     app.add(LoadCommand())
     app.add(RunCommand())
     app.add(CreateHTMLFileMap())
+    app.add(MemoryReportCommand())
     app.run()
\ No newline at end of file
@@ -9,9 +9,12 @@ from redis.commands.json.path import Path
 from redis.commands.search.commands import SEARCH_CMD, SearchCommands
 
 RETURN_FIELDS = ('COMPANY_NAME','para_contents','FILED_DATE', "FILE_NAME", "HTTP_FILE", "FILING_TYPE")
+DOCUMENT_KEY_FIELD = 'FILE_NAME'
+EMBEDDING_FIELD = 'embedding'
 
 _key_commands    = lambda guid: f'commands:{guid}'
 _key_filing = lambda index: f'filing:{index}'
+_key_document = lambda file_name: f'document:{file_name}'
 _key_term_facets = lambda term, _filter: f'term:{term}:{_filter if _filter else ""}:facets'
 _key_term_vector = lambda term: f'term:{term}:vector'
 _key_semaphore = lambda: f'semaphore:{int(time())}'
@@ -80,12 +83,21 @@ def set_filing_obj(r: Redis, obj: dict, index: int):
     return r.hmset(_key_filing(index), obj)
 
 def set_embedding_on_filing_obj(r: Redis, index: int, embedding: ndarray):
-    return r.hset(_key_filing(index), 'embedding', _convert_embedding_to_bytes(embedding))
+    return r.hset(_key_filing(index), EMBEDDING_FIELD, _convert_embedding_to_bytes(embedding))
+
+def set_filing_obj_with_embedding(r: Redis, obj: dict, index: int, embedding: ndarray):
+    return r.hset(_key_filing(index), mapping={**obj, EMBEDDING_FIELD: _convert_embedding_to_bytes(embedding)})
+
+def delete_filing_obj(r: Redis, index: int):
+    return r.delete(_key_filing(index))
+
+def set_document_obj(r: Redis, obj: dict, file_name: str):
+    return r.hset(_key_document(file_name), mapping=obj)
 
 def set_html_for_url(r: Redis, raw_url: str, html_url: str):
     return r.set(_key_url(raw_url), html_url)
 
-def query_filings(r: Redis, vector=None, _filter=None, k=10, log_guid=None, export_redis=None):
+def query_filings(r: Redis, vector=None, _filter=None, k=10, log_guid=None, export_redis=None, join_documents=True):
     if _filter is None and vector is not None:
         # only a vector to search for
         query_str = f'*=>[KNN $K @embedding $VECTOR]'
@@ -121,7 +133,37 @@ def query_filings(r: Redis, vector=None, _filter=None, k=10, log_guid=None, expo
 
     set_or_print_commands(export_redis, log_guid, query, results.duration)
 
-    return [result.__dict__ for result in results.docs], len(results.docs), results.duration
+    docs = [result.__dict__ for result in results.docs]
+    if join_documents:
+        _join_document_fields(r, docs, log_guid, export_redis)
+
+    return docs, len(docs), results.duration
+
+def _join_document_fields(r: Redis, docs: list, log_guid=None, export_redis=None):
+    # filings loaded in the compact layout only keep indexed fields on each paragraph -
+    # whatever else RETURN_FIELDS asks for lives once per filing under its document key
+    missing = [field for field in RETURN_FIELDS if any(field not in doc for doc in docs)]
+    if not missing:
+        return
+
+    file_names = list({doc[DOCUMENT_KEY_FIELD] for doc in docs if DOCUMENT_KEY_FIELD in doc})
+    if not file_names:
+        return
+
+    start = perf_counter()
+    with r.pipeline(transaction=False) as pipe:
+        for file_name in file_names:
+            pipe.hmget(_key_document(file_name), missing)
+        documents = dict(zip(file_names, pipe.execute()))
+    time = _get_time(start)
+
+    for doc in docs:
+        values = documents.get(doc.get(DOCUMENT_KEY_FIELD), ())
+        for field, value in zip(missing, values):
+            if field not in doc and value is not None:
+                doc[field] = value.decode('utf-8') if type(value) == bytes else value
+
+    set_or_print_commands(export_redis, log_guid, f'HMGET {_key_document("&lt;FILE_NAME&gt;")} {" ".join(missing)} (x{len(file_names)} pipelined)', time)
 
 def set_or_print_commands(redis: Redis, guid: str, command: str, time=0):
     if guid is not None:
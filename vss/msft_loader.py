@@ -2,6 +2,9 @@ from re import search
 from datetime import timedelta
 from time import perf_counter, sleep
 from pickle import load
+from queue import Queue, Empty, Full
+from threading import Thread, Event
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from random import triangular
 from json import dumps, loads
 from subprocess import Popen
@@ -10,24 +13,57 @@ from os.path import split
 from glob import glob
 
 import requests
-from numpy import datetime64
+from numpy import datetime64, zeros, array, float32
 from pandas import read_parquet, DatetimeIndex, DataFrame
+from pyarrow.parquet import ParquetFile
 from redis import Redis
 from redis.exceptions import ResponseError
 
 import prefect
 from prefect import task
-
-from vss.db import set_filing_obj, set_embedding_on_filing_obj, semaphore, set_html_for_url, get_html_for_url
+from prefect.utilities.logging import get_logger
+
+from vss.db import (set_filing_obj, 
+                    set_embedding_on_filing_obj, 
+                    set_filing_obj_with_embedding, 
+                    set_document_obj, 
+                    delete_filing_obj, 
+                    semaphore, 
+                    set_html_for_url, 
+                    get_html_for_url, 
+                    RETURN_FIELDS, 
+                    DOCUMENT_KEY_FIELD, 
+                    EMBEDDING_FIELD)
 
 VECTOR_DIMENSIONS = 768
 METADATA_NA_COLUMNS=['para_tag','COMPANY_NAME','SIC_INDUSTRY','SIC','FILING_TYPE']
-METADATA_INDEX_COLUMNS=['para_tag','para_contents','line_word_count','COMPANY_NAME','FILING_TYPE','SIC_INDUSTRY','DOC_COUNT','CIK_METADATA','all_capital','FILED_DATE_YEAR','FILED_DATE_MONTH','FILED_DATE_DAY']
+# (field, FT.CREATE arguments) - the single definition of what filing:idx indexes
+INDEX_SCHEMA = (('para_tag', ('TEXT',)),
+                ('para_contents', ('TEXT',)),
+                ('line_word_count', ('TEXT',)),
+                ('COMPANY_NAME', ('TAG',)),
+                ('FILING_TYPE', ('TEXT',)),
+                ('SIC_INDUSTRY', ('TEXT',)),
+                ('DOC_COUNT', ('NUMERIC',)),
+                ('CIK_METADATA', ('NUMERIC',)),
+                ('all_capital', ('NUMERIC',)),
+                ('FILED_DATE_YEAR', ('NUMERIC',)),
+                ('FILED_DATE_MONTH', ('NUMERIC',)),
+                ('FILED_DATE_DAY', ('NUMERIC',)),
+                ('embedding', ('VECTOR', 'HNSW', '12', 'TYPE', 'FLOAT32', 'DIM', str(VECTOR_DIMENSIONS), 'DISTANCE_METRIC', 'COSINE', 'INITIAL_CAP', '150000', 'M', '60', 'EF_CONSTRUCTION', '500')))
+METADATA_INDEX_COLUMNS = [field for field, _ in INDEX_SCHEMA if field != EMBEDDING_FIELD]
+# compact layout: paragraphs keep what the index needs plus the key to their filing,
+# returned fields that aren't indexed are stored once per filing
+PARAGRAPH_FIELDS = METADATA_INDEX_COLUMNS + [DOCUMENT_KEY_FIELD]
+DOCUMENT_FIELDS = [field for field in RETURN_FIELDS if field not in PARAGRAPH_FIELDS]
+MEMORY_REPORT_PREFIX = 'memory-report'
 SEC_MAX_PER_SECOND = 5
 SEC_URL_BASE = 'https://sec.gov/Archives/'
 RATE_LIMIT_ATTEMPT_MAX = 120
 MISSING_DOCS = ('edgar/data/1108524/0001108524-21-000014.txt', 'edgar/data/1108524/0001108524-20-000029.txt')
 INDEX_NAME = 'filing:idx'
+INDEX_PREFIX = 'filing:'
+STREAM_QUEUE_TIMEOUT = 1
 
 def _load_http_file_map():
     with open('data/filemap.json', 'r') as f:
@@ -35,16 +71,40 @@ def _load_http_file_map():
 
 HTTP_FILE_MAP = _load_http_file_map()
 
-def create_index(redis_url: str):
+def create_index(redis_url: str, compact: bool=False):
     r = Redis.from_url(redis_url)
 
+    if _index_exists(r):
+        if compact:
+            _check_index_prefix(r)
+        return
+    
+    schema = []
+    for field, args in INDEX_SCHEMA:
+        schema += [field, *args]
+
+    r.execute_command(*["FT.CREATE", INDEX_NAME, "ON", "HASH", "PREFIX", "1", INDEX_PREFIX, "SCHEMA", *schema])
+
+def _index_exists(r: Redis) -> bool:
     try:
         r.ft(INDEX_NAME).info()
-        return
+        return True
     except ResponseError:
-        pass
-    
-    r.execute_command(*["FT.CREATE", INDEX_NAME, "SCHEMA", "para_tag", "TEXT", "para_contents", "TEXT", "line_word_count", "TEXT", "COMPANY_NAME", "TAG", "FILING_TYPE", "TEXT", "SIC_INDUSTRY", "TEXT", "DOC_COUNT", "NUMERIC", "CIK_METADATA", "NUMERIC", "all_capital", "NUMERIC", "FILED_DATE_YEAR", "NUMERIC", "FILED_DATE_MONTH", "NUMERIC", "FILED_DATE_DAY", "NUMERIC", "embedding", "VECTOR", "HNSW", "12", "TYPE", "FLOAT32", "DIM", "768", "DISTANCE_METRIC", "COSINE", "INITIAL_CAP", "150000", "M", "60", "EF_CONSTRUCTION", "500"])
+        return False
+
+def _get_index_prefixes(r: Redis) -> list:
+    info = r.ft(INDEX_NAME).info()
+    _decode = lambda value: value.decode('utf-8') if type(value) == bytes else value
+    definition = info['index_definition']
+    definition = dict(zip(map(_decode, definition[::2]), definition[1::2]))
+    return [_decode(prefix) for prefix in definition.get('prefixes', [])]
+
+def _check_index_prefix(r: Redis):
+    # an index created before the PREFIX was added covers every hash, including
+    # document keys and memory report samples - refuse to write those under it
+    prefixes = _get_index_prefixes(r)
+    if prefixes != [INDEX_PREFIX]:
+        raise Exception(f'{INDEX_NAME} indexes prefixes {prefixes} instead of {INDEX_PREFIX!r} - drop it with FT.DROPINDEX {INDEX_NAME} and run load to recreate it')
 
 def download_data():
     
@@ -79,7 +139,7 @@ def mark_loader_failed(redis_url:str):
                             ######################################   
 
 @task(nout=2)
-def load_metadata(metadata_file: str, redis_url: str, pipeline_interval: int) -> tuple:
+def load_metadata(metadata_file: str, redis_url: str, pipeline_interval: int, compact: bool=False) -> tuple:
     logger = prefect.context.get('logger')
     logger.info(f'getting data from {metadata_file}')
     metadata = _munge_metadata(read_parquet(metadata_file))
@@ -88,14 +148,15 @@ def load_metadata(metadata_file: str, redis_url: str, pipeline_interval: int) ->
     data_map['offset'] = metadata.index.start
     data_map['records'] = metadata.to_dict('records')
     logger.info(f'file contained {len(data_map["records"])} records - transforming and loading into redis')
-    _load_metadata_records(data_map, redis_url, pipeline_interval)
-    
-    _file_key = metadata_file.split('_')[1:]
-    file_key = '_'.join(_file_key).split('.')[0]
+    _load_metadata_records(data_map, redis_url, pipeline_interval, compact)
+
+    return (_get_file_key(metadata_file), data_map['offset'])
 
-    return (file_key, data_map['offset'])
+def _get_file_key(metadata_file: str) -> str:
+    _file_key = metadata_file.split('_')[1:]
+    return '_'.join(_file_key).split('.')[0]
 
-def _load_metadata_records(data_map: dict, redis_url: str, pipeline_interval: int):
+def _load_metadata_records(data_map: dict, redis_url: str, pipeline_interval: int, compact: bool=False):
         logger = prefect.context.get('logger')
         
         r = Redis.from_url(redis_url)
@@ -105,10 +166,10 @@ def _load_metadata_records(data_map: dict, redis_url: str, pipeline_interval: in
             counter = 0
             total_counter = 0
             batch_start = perf_counter()
+            documents = set()
             
             for _metadata in data_map['records']:    
-                data = __build_object_from_row(_metadata)
-                set_filing_obj(pipe, data, offset)
+                _set_filing_from_row(pipe, _metadata, offset, compact, documents)
                 
                 if counter == pipeline_interval:
                     logger.debug('executing metadata batch')
@@ -130,6 +191,29 @@ def _load_metadata_records(data_map: dict, redis_url: str, pipeline_interval: in
         end = perf_counter()
         logger.info(f'work complete! {total_counter} records loaded to redis in {end-start:0.2f} seconds')
 
+def _set_filing_from_row(r: Redis, row: dict, offset: int, compact: bool, documents: set, embedding=None):
+    data = __build_object_from_row(row)
+
+    if compact:
+        data, document = _split_compact(data)
+        file_name = data[DOCUMENT_KEY_FIELD]
+        if file_name not in documents:
+            set_document_obj(r, document, file_name)
+            documents.add(file_name)
+
+        # HSET never removes fields, so clear out anything left over from a full layout load
+        delete_filing_obj(r, offset)
+
+    if embedding is None:
+        return set_filing_obj(r, data, offset)
+    else:
+        return set_filing_obj_with_embedding(r, data, offset, embedding)
+
+def _split_compact(data: dict) -> tuple:
+    paragraph = {field: data[field] for field in PARAGRAPH_FIELDS}
+    document = {field: data[field] for field in DOCUMENT_FIELDS}
+    return paragraph, document
+
 def _munge_metadata(metadata: DataFrame) -> DataFrame:
     metadata = __fill_nas(metadata)
     return metadata
@@ -184,11 +268,8 @@ def load_embeddings(args:tuple, redis_url: str, pipeline_interval: int):
     logger = prefect.context.get('logger')
     r = Redis.from_url(redis_url)
     start = perf_counter()
-    filename = f'data/embeddings_{file_key}.pkl'
-    logger.info(f'Opening embeddings file: {filename} | offset: {offset}')
-    
-    with open(filename, 'rb') as f:
-        embeddings = load(f)
+    logger.info(f'Opening embeddings file: {_embeddings_filename(file_key)} | offset: {offset}')
+    embeddings = _load_embeddings_file(file_key)
 
     logger.info(f'File contains {len(embeddings)} embeddings')
 
@@ -220,6 +301,216 @@ def load_embeddings(args:tuple, redis_url: str, pipeline_interval: int):
     end = perf_counter()
     logger.info(f'work complete! {total_counter} embeddings loaded to redis in {end-start:0.2f} seconds')
 
+def _embeddings_filename(file_key: str) -> str:
+    return f'data/embeddings_{file_key}.pkl'
+
+def _load_embeddings_file(file_key: str):
+    with open(_embeddings_filename(file_key), 'rb') as f:
+        return load(f)
+
+                    ##############################################
+                    ## STREAMING LOADER: Bounded Reader/Writers ##
+                    ##############################################
+
+# Sentinel handed to each writer once the reader has drained its file
+_STREAM_DONE = None
+
+def stream_load(metadata_files: list, redis_url: str, batch_size: int, processes: int, writers: int, queue_size: int, compact: bool=False) -> int:
+    '''
+    Load metadata and embeddings in a single pass without Prefect/Dask.
+
+    Each file is loaded in its own worker process, at most `processes` at a
+    time, so parsing and command packing scale across cores. Inside a worker
+    the reader walks the parquet file in batches of batch_size rows, pairing
+    each batch with a copy of its slice of the embeddings, and hands them to a
+    bounded queue. Writer threads drain the queue into Redis pipelines,
+    overlapping the round trips, writing metadata and embedding with one HSET
+    per filing. Once the queue is full the reader blocks, so the queued
+    batches are capped at (queue_size + writers + 1) per worker. On top of
+    that each worker holds the row group pyarrow is decoding and the whole
+    embeddings file (pickles cannot be read incrementally), so memory per
+    worker still grows with row group and embeddings file size.
+
+    Returns the number of records written.
+    '''
+    logger = get_logger('stream_load')
+    logger.info(f'streaming {len(metadata_files)} files with {processes} processes, {writers} writers each, queue size {queue_size} and batch size {batch_size}')
+    start = perf_counter()
+
+    total = 0
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        futures = [executor.submit(_stream_file, metadata_file, redis_url, batch_size, writers, queue_size, compact) for metadata_file in metadata_files]
+        try:
+            for future in as_completed(futures):
+                total += future.result()
+        except Exception:
+            for future in futures:
+                future.cancel()
+            raise
+
+    end = perf_counter()
+    logger.info(f'work complete! {total} records loaded to redis in {end-start:0.2f} seconds')
+    return total
+
+def _stream_file(metadata_file: str, redis_url: str, batch_size: int, writers: int, queue_size: int, compact: bool) -> int:
+    batches = Queue(maxsize=queue_size)
+    stop = Event()
+    errors = []
+    totals = []
+
+    writer_threads = [Thread(target=_stream_writer, args=(batches, redis_url, stop, errors, totals, compact), daemon=True) for _ in range(writers)]
+    for thread in writer_threads:
+        thread.start()
+
+    try:
+        for batch in _iter_metadata_file(metadata_file, batch_size):
+            if not _stream_put(batches, batch, stop):
+                break
+    except Exception as e:
+        errors.append(e)
+        stop.set()
+
+    for _ in writer_threads:
+        _stream_put(batches, _STREAM_DONE, stop)
+
+    for thread in writer_threads:
+        thread.join()
+
+    if errors:
+        raise errors[0]
+
+    return sum(totals)
+
+def _stream_put(batches: Queue, batch, stop: Event) -> bool:
+    while not stop.is_set():
+        try:
+            batches.put(batch, timeout=STREAM_QUEUE_TIMEOUT)
+            return True
+        except Full:
+            continue
+
+    return False
+
+def _iter_metadata_file(metadata_file: str, batch_size: int):
+    logger = get_logger('stream_load')
+    parquet_file = ParquetFile(metadata_file)
+    offset = _get_parquet_offset(parquet_file)
+    file_key = _get_file_key(metadata_file)
+    logger.info(f'streaming {metadata_file} | embeddings: {_embeddings_filename(file_key)} | offset: {offset}')
+
+    embeddings = _load_embeddings_file(file_key)
+    if len(embeddings) != parquet_file.metadata.num_rows:
+        raise ValueError(f'{metadata_file} has {parquet_file.metadata.num_rows} rows but {_embeddings_filename(file_key)} has {len(embeddings)} embeddings')
+
+    position = 0
+    for record_batch in parquet_file.iter_batches(batch_size=batch_size):
+        records = _munge_metadata(record_batch.to_pandas()).to_dict('records')
+        # copy the slice - a view would keep the whole embeddings array alive for as long as the batch is queued
+        yield offset + position, records, array(embeddings[position:position+len(records)], dtype=float32)
+        position += len(records)
+
+def _get_parquet_offset(parquet_file: ParquetFile) -> int:
+    # the batch loader takes the offset from the RangeIndex pandas stored with the
+    # file - row batches don't rebuild the index, so read it from the metadata
+    pandas_metadata = parquet_file.schema_arrow.pandas_metadata or {}
+    for index_column in pandas_metadata.get('index_columns', []):
+        if isinstance(index_column, dict) and index_column.get('kind') == 'range':
+            return index_column['start']
+
+    raise ValueError('metadata file is missing a RangeIndex to take the offset from')
+
+def _stream_writer(batches: Queue, redis_url: str, stop: Event, errors: list, totals: list, compact: bool):
+    r = Redis.from_url(redis_url)
+    counter = 0
+    try:
+        with r.pipeline(transaction=False) as pipe:
+            while not stop.is_set():
+                try:
+                    batch = batches.get(timeout=STREAM_QUEUE_TIMEOUT)
+                except Empty:
+                    continue
+
+                if batch is _STREAM_DONE:
+                    break
+
+                offset, records, embeddings = batch
+                documents = set()
+                for record, embedding in zip(records, embeddings):
+                    _set_filing_from_row(pipe, record, offset, compact, documents, embedding)
+                    offset += 1
+
+                pipe.execute()
+                counter += len(records)
+    except Exception as e:
+        errors.append(e)
+        stop.set()
+    finally:
+        totals.append(counter)
+
+                            #################################
+                            ## MEMORY REPORT: Full/Compact ##
+                            #################################
+
+def memory_report(metadata_file: str, redis_url: str, sample: int) -> dict:
+    '''
+    Write a sample of rows in both the full and compact layouts under throwaway
+    keys, and measure them with MEMORY USAGE. Embeddings are stood in for with
+    zero vectors of the same size. Sample keys are deleted afterwards.
+
+    Returns the average bytes per filing for each layout.
+    '''
+    r = Redis.from_url(redis_url)
+    if _index_exists(r):
+        _check_index_prefix(r)
+
+    record_batch = next(ParquetFile(metadata_file).iter_batches(batch_size=sample), None)
+    if record_batch is None or record_batch.num_rows == 0:
+        raise ValueError(f'{metadata_file} has no rows to sample')
+
+    records = _munge_metadata(record_batch.to_pandas()).to_dict('records')
+    embedding = zeros(VECTOR_DIMENSIONS, dtype=float32)
+
+    full_keys = [f'{MEMORY_REPORT_PREFIX}:full:{i}' for i in range(len(records))]
+    paragraph_keys = [f'{MEMORY_REPORT_PREFIX}:paragraph:{i}' for i in range(len(records))]
+    document_keys = {}
+
+    # the write pipeline isn't a transaction, so a failed execute can leave some
+    # samples behind - keep it inside the try so they're always deleted
+    try:
+        with r.pipeline(transaction=False) as pipe:
+            for full_key, paragraph_key, record in zip(full_keys, paragraph_keys, records):
+                data = __build_object_from_row(record)
+                paragraph, document = _split_compact(data)
+                pipe.hset(full_key, mapping={**data, EMBEDDING_FIELD: embedding.tobytes()})
+                pipe.hset(paragraph_key, mapping={**paragraph, EMBEDDING_FIELD: embedding.tobytes()})
+
+                document_key = f'{MEMORY_REPORT_PREFIX}:document:{paragraph[DOCUMENT_KEY_FIELD]}'
+                if document_key not in document_keys:
+                    document_keys[document_key] = document
+
+            for document_key, document in document_keys.items():
+                pipe.hset(document_key, mapping=document)
+
+            pipe.execute()
+
+        with r.pipeline(transaction=False) as pipe:
+            for key in full_keys + paragraph_keys + list(document_keys):
+                pipe.memory_usage(key, samples=0)
+            usage = pipe.execute()
+    finally:
+        r.delete(*(full_keys + paragraph_keys + list(document_keys)))
+
+    full = sum(usage[:len(records)])
+    paragraph = sum(usage[len(records):2*len(records)])
+    document = sum(usage[2*len(records):])
+
+    return {'records': len(records),
+            'documents': len(document_keys),
+            'full': full / len(records),
+            'paragraph': paragraph / len(records),
+            'document': document / len(records),
+            'compact': (paragraph + document) / len(records)}
+
                                             ##############################
                                             ## CREATE FILENAME MAP FILE ##
                                             ##############################
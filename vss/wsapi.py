@@ -45,7 +45,7 @@ def facets():
         return _facets
     try:
         vector = get_embedding(term)
-        results, _, _ = DB.query_filings(app.config['REDIS'], vector=vector, _filter=_filter, k=FACETS_K, log_guid=log_guid, export_redis=app.config['EXPORT_REDIS'])
+        results, _, _ = DB.query_filings(app.config['REDIS'], vector=vector, _filter=_filter, k=FACETS_K, log_guid=log_guid, export_redis=app.config['EXPORT_REDIS'], join_documents=False)
     except ResponseError:
         results = []
 